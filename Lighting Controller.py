@@ -1,11 +1,19 @@
+import asyncio
+import heapq
+import os
+import pickle
+import tempfile
+import threading
 from numpy import *
 from tkinter import *
 from tkinter import ttk
+from tkinter import filedialog
 import matplotlib.pyplot as plt
 from matplotlib import pylab as p
 from matplotlib.patches import Rectangle
 from matplotlib.backends.backend_tkagg import (
     FigureCanvasTkAgg, NavigationToolbar2Tk)
+from matplotlib.figure import Figure
 from matplotlib.font_manager import FontProperties
 fontP = FontProperties()
 fontP.set_size('small')
@@ -42,6 +50,23 @@ def get_sunlight(t, max_sun, cloud_cover, light_pollution, sunset):
     return max((1 - cloud_cover) * sun, 0) + light_pollution
 
 
+def get_clock_seconds(time_str):
+    # Accepts HH:MM, HH:MM:SS or decimal hours within one day
+    fields = time_str.split(":")
+    try:
+        if len(fields) > 3:
+            raise ValueError
+        hours, minutes, seconds = [float(i) for i in fields] + [0] * (3 - len(fields))
+    except ValueError:
+        raise ValueError("expected HH:MM, HH:MM:SS or decimal hours")
+    if not (0 <= hours < 24 and 0 <= minutes < 60 and 0 <= seconds < 60):
+        raise ValueError("hours must be in [0, 24) and minutes and seconds in [0, 60)")
+    total = int(round(3600 * hours + 60 * minutes + seconds))
+    if total >= 86400:
+        raise ValueError("time must be before 24:00")
+    return total
+
+
 class Drag_and_Drop_Handler:
     def __init__(self, fig=None):
         if fig is None:
@@ -67,6 +92,279 @@ class Drag_and_Drop_Handler:
         return True
 
 
+class Dimming_Schedule:
+    # Brightness profile of a light source in percent. A plain list ('50,100') is spread evenly over the run,
+    # otherwise items are time of day changepoints, 'HH:MM=level' steps and 'HH:MM~level' ramps linearly
+    # from the previous changepoint. The profile repeats every day. '@path' reads the items from a file.
+    def __init__(self, text):
+        text = text.strip()
+        if text.startswith('@'):
+            with open(text[1:]) as f:
+                text = f.read()
+        items = [i.strip() for i in text.replace("\n", ",").split(",") if i.strip()]
+        if len(items) == 0:
+            raise ValueError("Brightness schedule is empty")
+        self.stepped = not any(['=' in i or '~' in i for i in items])
+        self.times = []
+        self.levels = []
+        self.ramps = []
+        for item in items:
+            if self.stepped:
+                self.levels.append(self.parse_level(item, item))
+                continue
+            ramp = '~' in item
+            parts = item.split('~' if ramp else '=')
+            if len(parts) != 2 or ('=' in item and ramp):
+                raise ValueError("Brightness schedule item '{}' should be HH:MM=level or HH:MM~level, "
+                                 "plain levels cannot be mixed with timed ones".format(item))
+            try:
+                self.times.append(get_clock_seconds(parts[0]))
+            except ValueError as e:
+                raise ValueError("Brightness schedule item '{}' has an invalid time, {}".format(item, e))
+            self.levels.append(self.parse_level(parts[1], item))
+            self.ramps.append(ramp)
+
+    @staticmethod
+    def parse_level(level_str, item):
+        try:
+            return float(level_str)
+        except ValueError:
+            raise ValueError("Brightness schedule item '{}' has an invalid level".format(item))
+
+    def compile_day(self):
+        # One level per second of the day for a timed schedule, plain lists are indexed directly by the caller
+        order = argsort(self.times, kind='stable')
+        times = array(self.times)[order]
+        levels = array(self.levels, dtype=float)[order]
+        ramps = array(self.ramps, dtype=bool)[order]
+        # Wrap around midnight, the last changepoint of the previous day and the first of the next bound the day
+        times = concatenate([[times[-1] - 86400], times, [times[0] + 86400]])
+        levels = concatenate([[levels[-1]], levels, [levels[0]]])
+        ramps = concatenate([[ramps[-1]], ramps, [ramps[0]]])
+
+        t = arange(86400)
+        next_idx = searchsorted(times, t, side='right')
+        prev_idx = next_idx - 1
+        dense = levels[prev_idx]
+
+        ramping = ramps[next_idx]
+        prev_idx = prev_idx[ramping]
+        next_idx = next_idx[ramping]
+        ramp_frac = (t[ramping] - times[prev_idx]) / (times[next_idx] - times[prev_idx])
+        dense[ramping] = levels[prev_idx] + ramp_frac * (levels[next_idx] - levels[prev_idx])
+        return dense
+
+
+class Emulation_Clock:
+    # Maps simulation seconds onto the event loop clock, scale = sim seconds per wall second
+    def __init__(self, scale):
+        self.scale = scale
+        self.loop = None
+        self.origin = 0
+
+    def start(self):
+        self.loop = asyncio.get_running_loop()
+        self.origin = self.loop.time()
+
+    def loop_time(self, s):
+        return self.origin + s / self.scale
+
+    def now(self):
+        return (self.loop.time() - self.origin) * self.scale
+
+    async def sleep_until(self, s):
+        await asyncio.sleep(maximum(self.loop_time(s) - self.loop.time(), 0))
+
+    async def wait_until(self, event, s):
+        # Waits for the event but gives up at simulation second s
+        try:
+            await asyncio.wait_for(event.wait(), maximum(self.loop_time(s) - self.loop.time(), 0))
+        except asyncio.TimeoutError:
+            pass
+
+    def call_at(self, s, callback, *args):
+        return self.loop.call_at(self.loop_time(s), callback, *args)
+
+
+class Message_Broker:
+    # In-process stand-in for the device network, messages carry their simulated arrival time
+    def __init__(self, clock, latency, jitter, drop_rate):
+        self.clock = clock
+        self.latency = latency
+        self.jitter = jitter
+        self.drop_rate = drop_rate
+        self.queues = {}
+        self.sent = 0
+        self.dropped = 0
+
+    def subscribe(self, address):
+        self.queues[address] = asyncio.Queue()
+        return self.queues[address]
+
+    def publish(self, address, message, sent):
+        self.sent += 1
+        if random.uniform() < self.drop_rate:
+            self.dropped += 1
+            return
+        arrival = sent + maximum(random.normal(self.latency, self.jitter), 0)
+        self.clock.call_at(arrival, self.queues[address].put_nowait, (arrival, message))
+
+
+class Event_Scheduler:
+    # Time ordered heap of device events, ties are broken by insertion order
+    def __init__(self):
+        self.events = []
+        self.count = 0
+
+    def push(self, time, kind, device, data=None):
+        heapq.heappush(self.events, (time, self.count, kind, device, data))
+        self.count += 1
+
+    def pop_before(self, time):
+        while self.events and self.events[0][0] < time:
+            event_time, _, kind, device, data = heapq.heappop(self.events)
+            yield event_time, kind, device, data
+
+
+class Histogram:
+    # Fixed bins, samples outside the range are counted separately so they do not pile up in the end bins
+    def __init__(self, low, high, bins):
+        self.low = low
+        self.high = high
+        self.width = (high - low) / bins
+        self.edges = linspace(low, high, bins + 1)
+        self.counts = zeros(bins, dtype=int)
+        self.underflow = 0
+        self.overflow = 0
+
+    def update(self, x):
+        if x < self.low:
+            self.underflow += 1
+        elif x >= self.high:
+            self.overflow += 1
+        else:
+            idx = int(minimum((x - self.low) // self.width, len(self.counts) - 1))
+            self.counts[idx] += 1
+
+
+class P2_Quantile:
+    # Streaming quantile estimate with the P^2 algorithm (Jain and Chlamtac), keeps five markers
+    def __init__(self, p):
+        self.p = p
+        self.heights = []
+        self.positions = [1, 2, 3, 4, 5]
+        self.desired = [1, 1 + 2 * p, 1 + 4 * p, 3 + 2 * p, 5]
+        self.increments = [0, p / 2, p, (1 + p) / 2, 1]
+
+    def update(self, x):
+        q = self.heights
+        n = self.positions
+        if len(q) < 5:
+            q.append(x)
+            q.sort()
+            return
+        if x < q[0]:
+            q[0] = x
+            k = 0
+        elif x >= q[4]:
+            q[4] = x
+            k = 3
+        else:
+            k = 0
+            while x >= q[k + 1]:
+                k += 1
+        for i in range(k + 1, 5):
+            n[i] += 1
+        for i in range(5):
+            self.desired[i] += self.increments[i]
+        for i in range(1, 4):
+            d = self.desired[i] - n[i]
+            if (d >= 1 and n[i + 1] - n[i] > 1) or (d <= -1 and n[i - 1] - n[i] < -1):
+                d = 1 if d > 0 else -1
+                height = self.parabolic(i, d)
+                if not q[i - 1] < height < q[i + 1]:
+                    height = q[i] + d * (q[i + d] - q[i]) / (n[i + d] - n[i])
+                q[i] = height
+                n[i] += d
+
+    def parabolic(self, i, d):
+        q = self.heights
+        n = self.positions
+        return q[i] + d / (n[i + 1] - n[i - 1]) * ((n[i] - n[i - 1] + d) * (q[i + 1] - q[i]) / (n[i + 1] - n[i]) +
+                                                   (n[i + 1] - n[i] - d) * (q[i] - q[i - 1]) / (n[i] - n[i - 1]))
+
+    def value(self):
+        if len(self.heights) == 0:
+            return nan
+        if len(self.heights) < 5:
+            return self.heights[int(self.p * (len(self.heights) - 1) + 0.5)]
+        return self.heights[2]
+
+
+class KPI_Accumulator:
+    # Summary metrics updated once per simulated second, memory does not grow with run length
+    def __init__(self, max_lux, thresh, distributions, hist_range=100, hist_bins=40):
+        self.max_lux = max_lux
+        self.thresh = thresh
+        self.steps = 0
+        self.sq_err = 0
+        self.max_err = 0
+        self.time_outside = 0
+        self.light_energy = 0
+        self.h_travel = 0
+        self.theta_travel = 0
+        self.last_h = None
+        self.last_theta = None
+        self.err_hist = None
+        self.err_quantiles = []
+        # Clock seconds the metrics start from when they were switched on for a resumed run
+        self.resumed_at = None
+        if distributions:
+            self.err_hist = Histogram(-hist_range, hist_range, hist_bins)
+            self.err_quantiles = [P2_Quantile(0.5), P2_Quantile(0.95), P2_Quantile(0.99)]
+
+    def update(self, ref_lux, room_lux, levels, h, theta):
+        err = room_lux - ref_lux
+        self.steps += 1
+        self.sq_err += err ** 2
+        self.max_err = maximum(self.max_err, abs(err))
+        if abs(err) / self.max_lux > self.thresh:
+            self.time_outside += 1
+        for level in levels:
+            self.light_energy += level
+        if self.last_h is not None:
+            self.h_travel += abs(h - self.last_h)
+            self.theta_travel += abs(theta - self.last_theta)
+        self.last_h = h
+        self.last_theta = theta
+
+        if self.err_hist is not None:
+            rel_err = 100 * err / self.max_lux
+            self.err_hist.update(rel_err)
+            for quantile in self.err_quantiles:
+                quantile.update(abs(rel_err))
+
+    def hist_settings(self):
+        if self.err_hist is None:
+            return "off"
+        return "+/- {} % in {} bins".format(self.err_hist.high, len(self.err_hist.counts))
+
+    def summary(self):
+        rows = [['RMS Tracking Error [lux]', sqrt(self.sq_err / maximum(self.steps, 1))],
+                ['Max Tracking Error [lux]', self.max_err],
+                ['Time Outside Threshold [hr]', self.time_outside / 3600],
+                ['Time Outside Threshold [%]', 100 * self.time_outside / maximum(self.steps, 1)],
+                ['Artificial Light Energy [lm hr]', self.light_energy / 3600],
+                ['Blind Height Travel', self.h_travel],
+                ['Blind Tilt Travel [deg]', 180 * self.theta_travel / pi]]
+        for quantile in self.err_quantiles:
+            rows.append(['p{} |Error| [%]'.format(int(100 * quantile.p)), quantile.value()])
+        if self.err_hist is not None:
+            rows.append(['Error Below Histogram [hr]', self.err_hist.underflow / 3600])
+            rows.append(['Error Above Histogram [hr]', self.err_hist.overflow / 3600])
+        return rows
+
+
 class Root(Tk):
     def __init__(self):
         super(Root, self).__init__()
@@ -105,10 +403,52 @@ class Root(Tk):
         self.refs.set('25,50,25')
         self.use_window = BooleanVar()
         self.use_window.set(True)
+        self.latency = StringVar()
+        self.latency.set(50)
+        self.jitter = StringVar()
+        self.jitter.set(10)
+        self.drop_rate = StringVar()
+        self.drop_rate.set(1)
+        self.time_scale = StringVar()
+        self.time_scale.set(3600)
+        self.sensor_copies = StringVar()
+        self.sensor_copies.set(1)
+        self.reading_quorum = StringVar()
+        self.reading_quorum.set(95)
+        self.wake_period = StringVar()
+        self.wake_period.set(30)
+        self.listen_window = StringVar()
+        self.listen_window.set(5)
+        self.tx_time = StringVar()
+        self.tx_time.set(10)
+        self.rx_power = StringVar()
+        self.rx_power.set(20)
+        self.tx_power = StringVar()
+        self.tx_power.set(30)
+        self.max_retries = StringVar()
+        self.max_retries.set(3)
+        self.retry_timeout = StringVar()
+        self.retry_timeout.set(5)
+        self.record_traces = BooleanVar()
+        self.record_traces.set(True)
+        self.compute_kpis = BooleanVar()
+        self.compute_kpis.set(False)
+        self.kpi_distributions = BooleanVar()
+        self.kpi_distributions.set(False)
+        self.checkpoint_period = StringVar()
+        self.checkpoint_period.set(0)
+        self.run_name = StringVar()
+        self.run_name.set('run')
+        self.hist_range = StringVar()
+        self.hist_range.set(100)
+        self.hist_bins = StringVar()
+        self.hist_bins.set(40)
 
         self.initialize_layout()
         self.initialize_sim_parameters()
         self.initialize_controller_parameters()
+        self.initialize_network_parameters()
+        self.initialize_battery_parameters()
         self.initialize_sensor_frame()
         self.initialize_light_source_frame()
 
@@ -117,6 +457,16 @@ class Root(Tk):
                                  command=self.simulate)
         self.sim_button.grid(row=0,
                              column=2)
+        self.emulate_button = Button(self,
+                                     text="Run Emulation",
+                                     command=self.emulate)
+        self.emulate_button.grid(row=0,
+                                 column=3)
+        self.resume_button = Button(self,
+                                    text="Resume From Checkpoint",
+                                    command=self.resume)
+        self.resume_button.grid(row=3,
+                                column=2)
 
         self.num_sensors = 0
         self.sensor_ids = []
@@ -232,6 +582,71 @@ class Root(Tk):
         self.duration_entry.grid(column=1,
                                  row=6)
 
+        self.traces_checkbutton = Checkbutton(self.sim_parameters_frame,
+                                              text='Record Full Traces',
+                                              variable=self.record_traces)
+        self.traces_checkbutton.grid(column=0,
+                                     columnspan=2,
+                                     row=7)
+
+        self.kpi_checkbutton = Checkbutton(self.sim_parameters_frame,
+                                           text='Compute Summary Metrics',
+                                           variable=self.compute_kpis)
+        self.kpi_checkbutton.grid(column=0,
+                                  columnspan=2,
+                                  row=8)
+
+        self.distribution_checkbutton = Checkbutton(self.sim_parameters_frame,
+                                                    text='Error Histogram and Quantiles',
+                                                    variable=self.kpi_distributions)
+        self.distribution_checkbutton.grid(column=0,
+                                           columnspan=2,
+                                           row=9)
+
+        self.checkpoint_label = Label(self.sim_parameters_frame,
+                                      text="Checkpoint Every [hr]")
+        self.checkpoint_label.grid(row=10,
+                                   column=0)
+        self.checkpoint_entry = Entry(self.sim_parameters_frame,
+                                      textvariable=self.checkpoint_period,
+                                      width=10,
+                                      justify="center")
+        self.checkpoint_entry.grid(column=1,
+                                   row=10)
+
+        self.run_name_label = Label(self.sim_parameters_frame,
+                                    text="Checkpoint Run Name")
+        self.run_name_label.grid(row=11,
+                                 column=0)
+        self.run_name_entry = Entry(self.sim_parameters_frame,
+                                    textvariable=self.run_name,
+                                    width=10,
+                                    justify="center")
+        self.run_name_entry.grid(column=1,
+                                 row=11)
+
+        self.hist_range_label = Label(self.sim_parameters_frame,
+                                      text="Histogram Range [+/- %]")
+        self.hist_range_label.grid(row=12,
+                                   column=0)
+        self.hist_range_entry = Entry(self.sim_parameters_frame,
+                                      textvariable=self.hist_range,
+                                      width=10,
+                                      justify="center")
+        self.hist_range_entry.grid(column=1,
+                                   row=12)
+
+        self.hist_bins_label = Label(self.sim_parameters_frame,
+                                     text="Histogram Bins")
+        self.hist_bins_label.grid(row=13,
+                                  column=0)
+        self.hist_bins_entry = Entry(self.sim_parameters_frame,
+                                     textvariable=self.hist_bins,
+                                     width=10,
+                                     justify="center")
+        self.hist_bins_entry.grid(column=1,
+                                  row=13)
+
     def initialize_controller_parameters(self):
         self.control_frame = LabelFrame(self,
                                         text="Controller Parameters")
@@ -331,6 +746,165 @@ class Root(Tk):
                                          columnspan=2,
                                          row=8)
 
+    def initialize_network_parameters(self):
+        self.network_frame = LabelFrame(self,
+                                        text="Network Parameters")
+        self.network_frame.grid(column=3,
+                                row=1,
+                                padx=20,
+                                pady=20)
+
+        self.latency_label = Label(self.network_frame,
+                                   text="Latency [ms]")
+        self.latency_label.grid(row=0,
+                                column=0)
+        self.latency_entry = Entry(self.network_frame,
+                                   textvariable=self.latency,
+                                   width=10,
+                                   justify="center")
+        self.latency_entry.grid(column=1,
+                                row=0)
+
+        self.jitter_label = Label(self.network_frame,
+                                  text="Jitter [ms]")
+        self.jitter_label.grid(row=1,
+                               column=0)
+        self.jitter_entry = Entry(self.network_frame,
+                                  textvariable=self.jitter,
+                                  width=10,
+                                  justify="center")
+        self.jitter_entry.grid(column=1,
+                               row=1)
+
+        self.drop_rate_label = Label(self.network_frame,
+                                     text="Drop Rate [%]")
+        self.drop_rate_label.grid(row=2,
+                                  column=0)
+        self.drop_rate_entry = Entry(self.network_frame,
+                                     textvariable=self.drop_rate,
+                                     width=10,
+                                     justify="center")
+        self.drop_rate_entry.grid(column=1,
+                                  row=2)
+
+        self.time_scale_label = Label(self.network_frame,
+                                      text="Clock Speed-Up [x]")
+        self.time_scale_label.grid(row=3,
+                                   column=0)
+        self.time_scale_entry = Entry(self.network_frame,
+                                      textvariable=self.time_scale,
+                                      width=10,
+                                      justify="center")
+        self.time_scale_entry.grid(column=1,
+                                   row=3)
+
+        self.sensor_copies_label = Label(self.network_frame,
+                                         text="Emulated Copies per Sensor")
+        self.sensor_copies_label.grid(row=4,
+                                      column=0)
+        self.sensor_copies_entry = Entry(self.network_frame,
+                                         textvariable=self.sensor_copies,
+                                         width=10,
+                                         justify="center")
+        self.sensor_copies_entry.grid(column=1,
+                                      row=4)
+
+        self.reading_quorum_label = Label(self.network_frame,
+                                          text="Reading Quorum [%]")
+        self.reading_quorum_label.grid(row=5,
+                                       column=0)
+        self.reading_quorum_entry = Entry(self.network_frame,
+                                          textvariable=self.reading_quorum,
+                                          width=10,
+                                          justify="center")
+        self.reading_quorum_entry.grid(column=1,
+                                       row=5)
+
+
+    def initialize_battery_parameters(self):
+        self.battery_frame = LabelFrame(self,
+                                        text="Battery Device Parameters")
+        self.battery_frame.grid(column=3,
+                                row=2,
+                                padx=20,
+                                pady=20)
+
+        self.wake_period_label = Label(self.battery_frame,
+                                       text="Wake Period [s]")
+        self.wake_period_label.grid(row=0,
+                                    column=0)
+        self.wake_period_entry = Entry(self.battery_frame,
+                                       textvariable=self.wake_period,
+                                       width=10,
+                                       justify="center")
+        self.wake_period_entry.grid(column=1,
+                                    row=0)
+
+        self.listen_window_label = Label(self.battery_frame,
+                                         text="Listen Window [ms]")
+        self.listen_window_label.grid(row=1,
+                                      column=0)
+        self.listen_window_entry = Entry(self.battery_frame,
+                                         textvariable=self.listen_window,
+                                         width=10,
+                                         justify="center")
+        self.listen_window_entry.grid(column=1,
+                                      row=1)
+
+        self.tx_time_label = Label(self.battery_frame,
+                                   text="Transmit Time [ms]")
+        self.tx_time_label.grid(row=2,
+                                column=0)
+        self.tx_time_entry = Entry(self.battery_frame,
+                                   textvariable=self.tx_time,
+                                   width=10,
+                                   justify="center")
+        self.tx_time_entry.grid(column=1,
+                                row=2)
+
+        self.rx_power_label = Label(self.battery_frame,
+                                    text="Receive Power [mW]")
+        self.rx_power_label.grid(row=3,
+                                 column=0)
+        self.rx_power_entry = Entry(self.battery_frame,
+                                    textvariable=self.rx_power,
+                                    width=10,
+                                    justify="center")
+        self.rx_power_entry.grid(column=1,
+                                 row=3)
+
+        self.tx_power_label = Label(self.battery_frame,
+                                    text="Transmit Power [mW]")
+        self.tx_power_label.grid(row=4,
+                                 column=0)
+        self.tx_power_entry = Entry(self.battery_frame,
+                                    textvariable=self.tx_power,
+                                    width=10,
+                                    justify="center")
+        self.tx_power_entry.grid(column=1,
+                                 row=4)
+
+        self.max_retries_label = Label(self.battery_frame,
+                                       text="Max Retries")
+        self.max_retries_label.grid(row=5,
+                                    column=0)
+        self.max_retries_entry = Entry(self.battery_frame,
+                                       textvariable=self.max_retries,
+                                       width=10,
+                                       justify="center")
+        self.max_retries_entry.grid(column=1,
+                                    row=5)
+
+        self.retry_timeout_label = Label(self.battery_frame,
+                                         text="Retry Timeout [s]")
+        self.retry_timeout_label.grid(row=6,
+                                      column=0)
+        self.retry_timeout_entry = Entry(self.battery_frame,
+                                         textvariable=self.retry_timeout,
+                                         width=10,
+                                         justify="center")
+        self.retry_timeout_entry.grid(column=1,
+                                      row=6)
 
     def initialize_sensor_frame(self):
         self.sensor_frame = LabelFrame(self,
@@ -514,108 +1088,447 @@ class Root(Tk):
         self.light_source_notebook.forget(tab_name)
 
     def simulate(self):
+        self.initialize_simulation()
+
+        self.time = []
+        self.outside_light = []
+        self.reference_light = []
+        self.room_light = []
+        self.m_light = []
+
+        self.checkpoint_parent = None
+        self.run_simulation(0)
+
+    def resume(self):
+        path = filedialog.askopenfilename(title='Resume From Checkpoint',
+                                          filetypes=[('Checkpoints', '*.pkl')])
+        if not path:
+            return
+        with open(path, 'rb') as f:
+            snapshot = pickle.load(f)
+        self.initialize_simulation()
+        self.restore_snapshot(snapshot)
+        self.checkpoint_parent = path
+        self.run_simulation(snapshot['cursor'])
+
+    def run_simulation(self, start):
+        if self.checkpoint_freq > 0:
+            self.checkpoint_dir = self.create_checkpoint_dir()
+        for s in range(start, self.duration_s):
+            t = self.start_s + s
+            if self.checkpoint_freq > 0 and s > start and s % self.checkpoint_freq == 0:
+                name = "checkpoint_{:02d}h{:02d}m{:02d}s.pkl".format(t // 3600, t % 3600 // 60, t % 60)
+                self.save_checkpoint(os.path.join(self.checkpoint_dir, name), s)
+            sunlight = self.get_environment(s)
+            levels = self.get_light_levels(s)
+
+            # Re-read the reference on resume so forks pick up an edited schedule straight away
+            if s % self.ref_freq == 0 or s == start:
+                self.ref = self.ref_levels[s // self.ref_freq]
+            if s % self.measure_freq == 0:
+                if self.use_battery:
+                    self.measured_light[0] = random.normal(sunlight, 0.01)
+                    self.partial_measure_light(levels, sunlight)
+                    self.poll_battery_sensors(s)
+                else:
+                    self.measure_light(levels, sunlight)
+                self.control()
+            elif s % self.measure_freq < self.timeout_s and abs(self.err) > self.thresh:
+                self.partial_measure_light(levels, sunlight)
+                if self.use_battery:
+                    self.poll_battery_sensors(s)
+                self.control()
+            if self.use_battery:
+                self.process_events(s, levels, sunlight)
+
+            room = self.get_room_light(levels, sunlight)
+
+            if self.kpis is not None:
+                self.kpis.update(self.ref * self.max_lux, room, levels, self.h, self.theta)
+            if self.traces:
+                self.time.append(t / 3600)
+                self.outside_light.append(sunlight)
+                self.reference_light.append(self.ref * self.max_lux)
+                self.room_light.append(room)
+                self.m_light.append(mean(self.measured_light[1:]))
+
+        if self.use_battery:
+            self.finalize_battery_devices()
+        if self.traces:
+            self.open_plot_window()
+        if self.kpis is not None:
+            self.open_kpi_window()
+        if self.use_battery:
+            self.open_device_window()
+
+    def initialize_simulation(self):
         ref_str = self.refs.get().split(",")
-        refs = [float(i) / 100 for i in ref_str]
+        self.ref_levels = [float(i) / 100 for i in ref_str]
 
         cloud_str = self.cloud.get().split(",")
-        clouds = [float(i) / 100 for i in cloud_str]
+        self.clouds = [float(i) / 100 for i in cloud_str]
 
-        light_sources = []
-        for i in range(self.num_light_source):
-            light_str = self.light_source_tabs[i][3].get().split(",")
-            light = [float(i) / 100 for i in light_str]
-            light_sources.append(light)
-
-        start_time = int(3600 * float(self.start_time.get()))
-        duration = int(3600 * float(self.duration.get())) + 1
+        self.start_s = int(3600 * float(self.start_time.get()))
+        self.duration_s = int(3600 * float(self.duration.get())) + 1
 
         self.max_lux = float(self.max_lux_str.get())
-        ref_freq = int(ceil(duration / len(refs)))
-        ref_idx = -1
+        self.ref_freq = int(ceil(self.duration_s / len(self.ref_levels)))
         self.ref = 0
-        timeout = int(self.timeout.get())
+        self.timeout_s = int(self.timeout.get())
         self.err = 0
         self.thresh = float(self.err_thresh.get()) / 100
-        use_battery = self.use_response.get()
+        self.use_battery = self.use_response.get()
+        self.window_sensor = self.use_window.get()
 
-        measure_freq = int(self.sample_period.get())
+        self.measure_freq = int(self.sample_period.get())
         self.measured_light = zeros(self.num_sensors + 1)
         self.alpha_h = float(self.height_step_size.get())
         self.alpha_theta = float(self.tilt_step_size.get())
         self.initialize_sensors_and_lights()
 
-        max_sun = float(self.max_sun.get())
-        light_pollution = float(self.light_pollution.get())
-        sunset = float(self.sunset.get())
+        self.max_sun_lux = float(self.max_sun.get())
+        self.light_pollution_lux = float(self.light_pollution.get())
+        self.sunset_lux = float(self.sunset.get())
+
+        self.checkpoint_freq = int(3600 * float(self.checkpoint_period.get()))
 
         self.h = 0.25
         self.theta = pi / 180
-
+        self.sensor_reads = zeros(self.num_sensors, dtype=int)
+        self.traces = self.record_traces.get()
+        self.kpis = None
+        if self.compute_kpis.get():
+            self.kpis = KPI_Accumulator(self.max_lux, self.thresh, self.kpi_distributions.get(),
+                                        float(self.hist_range.get()), int(self.hist_bins.get()))
+        if self.use_battery:
+            self.initialize_battery_devices()
+
+    def take_snapshot(self, cursor):
+        snapshot = {'cursor': cursor,
+                    'start_s': self.start_s,
+                    'duration_s': self.duration_s,
+                    'num_sensors': self.num_sensors,
+                    'num_light_source': self.num_light_source,
+                    'h': self.h,
+                    'theta': self.theta,
+                    'err': self.err,
+                    'ref': self.ref,
+                    'measured_light': self.measured_light,
+                    'sensor_reads': self.sensor_reads,
+                    'rng': random.get_state(),
+                    'kpis': self.kpis}
+        if self.traces:
+            snapshot['traces'] = [self.time, self.outside_light, self.reference_light, self.room_light, self.m_light]
+        if self.use_battery:
+            snapshot['battery'] = [self.scheduler, self.wake_phase, self.poll_pending,
+                                   self.num_responses, self.num_transmits, self.failed_polls]
+        return snapshot
+
+    def create_checkpoint_dir(self):
+        # Every run and every fork gets a new directory, so no lineage can overwrite another's checkpoints
+        if self.checkpoint_parent is None:
+            base = 'checkpoints'
+            prefix = self.run_name.get() + '_'
+        else:
+            lineage_dir = os.path.dirname(os.path.abspath(self.checkpoint_parent))
+            base = os.path.dirname(lineage_dir)
+            tag = os.path.splitext(os.path.basename(self.checkpoint_parent))[0].replace('checkpoint_', '')
+            prefix = '{}-{}_'.format(os.path.basename(lineage_dir), tag)
+        os.makedirs(base, exist_ok=True)
+        return tempfile.mkdtemp(prefix=prefix, dir=base)
+
+    def save_checkpoint(self, path, cursor):
+        # Write then rename so a preempted job never leaves a truncated checkpoint behind
+        with open(path + '.tmp', 'wb') as f:
+            pickle.dump(self.take_snapshot(cursor), f)
+        os.replace(path + '.tmp', path)
+
+    def restore_snapshot(self, snapshot):
+        if snapshot['num_sensors'] != self.num_sensors or snapshot['num_light_source'] != self.num_light_source:
+            raise ValueError("Checkpoint has {} sensors and {} light sources, layout has {} and {}".format(
+                snapshot['num_sensors'], snapshot['num_light_source'], self.num_sensors, self.num_light_source))
+        self.start_s = snapshot['start_s']
+        self.duration_s = snapshot['duration_s']
+        self.ref_freq = int(ceil(self.duration_s / len(self.ref_levels)))
+        self.compile_light_profiles()
+        self.h = snapshot['h']
+        self.theta = snapshot['theta']
+        self.err = snapshot['err']
+        self.ref = snapshot['ref']
+        self.measured_light = snapshot['measured_light']
+        self.sensor_reads = snapshot['sensor_reads']
+        random.set_state(snapshot['rng'])
+
+        if self.kpis is not None and snapshot['kpis'] is None:
+            self.kpis.resumed_at = self.start_s + snapshot['cursor']
+        elif self.kpis is not None:
+            restored = snapshot['kpis']
+            if restored.hist_settings() != self.kpis.hist_settings():
+                raise ValueError("Checkpoint error histogram is {}, settings give {}, "
+                                 "resume with the same histogram options".format(restored.hist_settings(),
+                                                                                 self.kpis.hist_settings()))
+            restored.max_lux = self.kpis.max_lux
+            restored.thresh = self.kpis.thresh
+            self.kpis = restored
         self.time = []
         self.outside_light = []
         self.reference_light = []
         self.room_light = []
         self.m_light = []
-
-        for s in range(duration):
-            t = start_time + s
-            fraction = s / duration
-
-            cloud_cover = get_cloud_cover(fraction, clouds)
-            sunlight = get_sunlight(t, max_sun, cloud_cover, light_pollution, sunset)
-
-            if s % ref_freq == 0:
-                ref_idx += 1
-                self.ref = refs[ref_idx]
-            if s % measure_freq == 0:
-                self.measure_light(fraction, sunlight)
-                self.control()
-            elif s % measure_freq < timeout and abs(self.err) > self.thresh:
-                if use_battery:
-                    self.measure_light(fraction, sunlight)
-                else:
-                    self.partial_measure_light(fraction, sunlight)
-                self.control()
-
-            room = self.get_room_light(fraction, sunlight)
-
-            self.time.append(t / 3600)
-            self.outside_light.append(sunlight)
-            self.reference_light.append(self.ref * self.max_lux)
-            self.room_light.append(room)
-            self.m_light.append(mean(self.measured_light[1:]))
-
-        self.open_plot_window()
-
-    def measure_light(self, fraction, sunlight):
+        if self.traces and 'traces' in snapshot:
+            self.time, self.outside_light, self.reference_light, self.room_light, self.m_light = snapshot['traces']
+        if self.use_battery and 'battery' in snapshot:
+            self.scheduler, self.wake_phase, self.poll_pending, \
+                self.num_responses, self.num_transmits, self.failed_polls = snapshot['battery']
+
+    def get_environment(self, s):
+        fraction = s / self.duration_s
+        cloud_cover = get_cloud_cover(fraction, self.clouds)
+        return get_sunlight(self.start_s + s, self.max_sun_lux, cloud_cover,
+                            self.light_pollution_lux, self.sunset_lux)
+
+    def get_profile_levels(self, s):
+        levels = empty(self.num_profiles)
+        levels[self.daily_profiles] = self.daily_levels[(self.start_s + s) % 86400]
+        even_idx = floor(s / self.duration_s * self.even_counts).astype(int)
+        levels[self.even_profiles] = self.even_levels[arange(len(self.even_profiles)), even_idx]
+        return levels
+
+    def get_light_levels(self, s):
+        return self.get_profile_levels(s)[self.light_profile_idx]
+
+    def get_profile_run(self, p):
+        # Level of one profile at every step of the run
+        steps = arange(self.duration_s)
+        if p in self.daily_profiles:
+            col = flatnonzero(self.daily_profiles == p)[0]
+            return self.daily_levels[(self.start_s + steps) % 86400, col]
+        row = flatnonzero(self.even_profiles == p)[0]
+        return self.even_levels[row, floor(steps / self.duration_s * self.even_counts[row]).astype(int)]
+
+    def sensor_lux(self, i, window_light, levels):
+        self.sensor_reads[i] += 1
+        dst = self.sensor_x[i] ** 2 + (self.sensor_y[i] - 2.5) ** 2
+        lux = random.normal(window_light, 0.01) / dst
+        for j in range(self.num_light_source):
+            dst_x = (self.sensor_x[i] - self.light_source_x[j]) ** 2
+            dst_y = (self.sensor_y[i] - self.light_source_y[j]) ** 2
+            dst = dst_x + dst_y
+            lux += random.normal(levels[j], 0.01) / dst
+        return lux
+
+    def measure_light(self, levels, sunlight):
         self.measured_light[0] = random.normal(sunlight, 0.01)
         window_light = 2 * WINDOW_AREA * (1 - self.h * cos(self.theta)) * sunlight
         for i in range(self.num_sensors):
-            dst = self.sensor_x[i] ** 2 + (self.sensor_y[i] - 2.5) ** 2
-            lux = random.normal(window_light, 0.01) / dst
-            for j in range(self.num_light_source):
-                dst_x = (self.sensor_x[i] - self.light_source_x[j]) ** 2
-                dst_y = (self.sensor_y[i] - self.light_source_y[j]) ** 2
-                dst = dst_x + dst_y
-                idx = floor(fraction * len(self.light_source_level[j])).astype(int)
-                lum = self.light_source_level[j][idx]
-                lux += random.normal(lum, 0.01) / dst
-            self.measured_light[i + 1] = lux
+            self.measured_light[i + 1] = self.sensor_lux(i, window_light, levels)
 
-    def partial_measure_light(self, fraction, sunlight):
+    def partial_measure_light(self, levels, sunlight):
         window_light = 2 * WINDOW_AREA * (1 - self.h * cos(self.theta)) * sunlight
         for i in range(self.num_sensors):
             if not self.sensor_battery[i]:
-                dst = self.sensor_x[i] ** 2 + (self.sensor_y[i] - 2.5) ** 2
-                lux = random.normal(window_light, 0.01) / dst
-                for j in range(self.num_light_source):
-                    dst_x = (self.sensor_x[i] - self.light_source_x[j]) ** 2
-                    dst_y = (self.sensor_y[i] - self.light_source_y[j]) ** 2
-                    dst = dst_x + dst_y
-                    idx = floor(fraction * len(self.light_source_level[j])).astype(int)
-                    lum = self.light_source_level[j][idx]
-                    lux += random.normal(lum, 0.01) / dst
-                self.measured_light[i + 1] = lux
+                self.measured_light[i + 1] = self.sensor_lux(i, window_light, levels)
+
+    def initialize_battery_devices(self):
+        self.scheduler = Event_Scheduler()
+        self.wake_s = float(self.wake_period.get())
+        self.listen_s = float(self.listen_window.get()) / 1000
+        self.tx_s = float(self.tx_time.get()) / 1000
+        self.rx_mw = float(self.rx_power.get())
+        self.tx_mw = float(self.tx_power.get())
+        self.retries = int(self.max_retries.get())
+        self.retry_s = float(self.retry_timeout.get())
+        self.radio_latency = float(self.latency.get()) / 1000
+        self.radio_jitter = float(self.jitter.get()) / 1000
+        self.radio_drop = float(self.drop_rate.get()) / 100
+
+        self.wake_phase = random.uniform(0, self.wake_s, self.num_sensors)
+        self.poll_pending = zeros(self.num_sensors, dtype=bool)
+        self.num_responses = zeros(self.num_sensors, dtype=int)
+        self.num_transmits = zeros(self.num_sensors, dtype=int)
+        self.failed_polls = zeros(self.num_sensors, dtype=int)
+
+    def next_wake(self, i, t):
+        return self.wake_phase[i] + ceil((t - self.wake_phase[i]) / self.wake_s) * self.wake_s
+
+    def poll_battery_sensors(self, s):
+        for i in range(self.num_sensors):
+            if self.sensor_battery[i] and not self.poll_pending[i]:
+                self.poll_pending[i] = True
+                self.scheduler.push(s, 'poll', i)
+
+    def process_events(self, s, levels, sunlight):
+        # Step s covers the plant second [s, s + 1), so every event popped here sees that second's lighting and blind
+        for time, kind, i, data in self.scheduler.pop_before(s + 1):
+            if kind == 'poll':
+                self.scheduler.push(self.next_wake(i, time), 'wake', i, 0)
+            elif kind == 'wake':
+                # The poll waits at the gateway until the sensor listens, either leg of the exchange can be lost
+                if random.uniform() < self.radio_drop:
+                    self.scheduler.push(time + self.retry_s, 'retry', i, data)
+                    continue
+                self.num_transmits[i] += 1
+                window_light = 2 * WINDOW_AREA * (1 - self.h * cos(self.theta)) * sunlight
+                lux = self.sensor_lux(i, window_light, levels)
+                if random.uniform() < self.radio_drop:
+                    self.scheduler.push(time + self.retry_s, 'retry', i, data)
+                    continue
+                delay = self.listen_s + self.tx_s + maximum(random.normal(self.radio_latency, self.radio_jitter), 0)
+                self.scheduler.push(time + delay, 'response', i, lux)
+            elif kind == 'response':
+                self.poll_pending[i] = False
+                self.num_responses[i] += 1
+                self.measured_light[i + 1] = data
+                self.control()
+            elif kind == 'retry':
+                if data < self.retries:
+                    self.scheduler.push(self.next_wake(i, time), 'wake', i, data + 1)
+                else:
+                    self.poll_pending[i] = False
+                    self.failed_polls[i] += 1
+
+    def finalize_battery_devices(self):
+        # Idle wake-ups are periodic so they are counted rather than scheduled
+        self.num_wakes = ceil((self.duration_s - self.wake_phase) / self.wake_s).astype(int)
+        self.radio_on = self.num_wakes * self.listen_s + self.num_transmits * self.tx_s
+        self.energy = (self.num_wakes * self.listen_s * self.rx_mw + self.num_transmits * self.tx_s * self.tx_mw) / 1000
+
+    def emulate(self):
+        self.initialize_simulation()
+        self.replicate_sensors(int(self.sensor_copies.get()))
+        # With a large fleet some reading is nearly always lost, so the controller acts once a quorum is in
+        quorum = float(self.reading_quorum.get()) / 100
+        self.quorum_readings = int(clip(ceil(quorum * (self.num_emulated + 1)), 1, self.num_emulated + 1))
+        clock = Emulation_Clock(float(self.time_scale.get()))
+        broker = Message_Broker(clock,
+                                float(self.latency.get()) / 1000,
+                                float(self.jitter.get()) / 1000,
+                                float(self.drop_rate.get()) / 100)
+        self.loop_latency = []
+        self.reading_latency = []
+        self.num_cycles = 0
+        self.missed_readings = 0
+        # The event loop runs off the Tk thread so the GUI stays live, in real time this lasts the whole run.
+        # It drives the controller state on self, so nothing else may start a run until it finishes
+        for button in (self.sim_button, self.emulate_button, self.resume_button):
+            button['state'] = DISABLED
+        self.emulation_thread = threading.Thread(target=asyncio.run,
+                                                 args=(self.run_emulation(clock, broker),),
+                                                 daemon=True)
+        self.emulation_thread.start()
+        self.after(100, self.check_emulation, broker)
+
+    def check_emulation(self, broker):
+        if self.emulation_thread.is_alive():
+            self.after(100, self.check_emulation, broker)
+            return
+        for button in (self.sim_button, self.emulate_button, self.resume_button):
+            button['state'] = NORMAL
+        self.open_latency_window(broker)
+
+    def replicate_sensors(self, copies):
+        # Each placed sensor stands for a group of devices scattered within a sensor width of it
+        self.sensor_x = list(repeat(self.sensor_x, copies) + random.normal(0, SW / 2, self.num_sensors * copies))
+        self.sensor_y = list(repeat(self.sensor_y, copies) + random.normal(0, SH / 2, self.num_sensors * copies))
+        self.sensor_battery = list(repeat(self.sensor_battery, copies))
+        self.num_emulated = len(self.sensor_x)
+        self.measured_light = zeros(self.num_emulated + 1)
+        self.sensor_reads = zeros(self.num_emulated, dtype=int)
+
+    async def run_emulation(self, clock, broker):
+        clock.start()
+        self.blind_h = self.h
+        self.blind_theta = self.theta
+        self.emulated_levels = array(self.get_light_levels(0), dtype=float)
+        self.cycle = -1
+        self.cycle_start = 0
+        self.cycle_readings = 0
+        self.cycle_ready = asyncio.Event()
+
+        devices = []
+        for i in range(self.num_emulated + 1):
+            devices.append(self.emulated_sensor(broker, broker.subscribe(('sensor', i)), i))
+        for j in range(self.num_light_source):
+            devices.append(self.emulated_light(broker, broker.subscribe(('light', j)), j))
+        devices.append(self.emulated_blind(broker, broker.subscribe('blind')))
+        devices.append(self.emulated_collector(broker, broker.subscribe('controller')))
+        tasks = [asyncio.create_task(d) for d in devices]
+
+        await asyncio.gather(self.emulated_dimmer(clock, broker),
+                             self.emulated_controller(clock, broker))
+        await clock.sleep_until(self.duration_s)
+        for task in tasks:
+            task.cancel()
+
+    async def emulated_sensor(self, broker, inbox, i):
+        while True:
+            arrival, (cycle, cycle_start) = await inbox.get()
+            sunlight = self.get_environment(minimum(int(arrival), self.duration_s - 1))
+            if i == 0:
+                lux = random.normal(sunlight, 0.01)
+            else:
+                window_light = 2 * WINDOW_AREA * (1 - self.blind_h * cos(self.blind_theta)) * sunlight
+                lux = self.sensor_lux(i - 1, window_light, self.emulated_levels)
+            broker.publish('controller', (cycle, i, lux), arrival)
+
+    async def emulated_light(self, broker, inbox, j):
+        while True:
+            _, level = await inbox.get()
+            self.emulated_levels[j] = level
+
+    async def emulated_blind(self, broker, inbox):
+        while True:
+            arrival, (cycle_start, h, theta) = await inbox.get()
+            self.blind_h = h
+            self.blind_theta = theta
+            self.loop_latency.append(arrival - cycle_start)
+
+    async def emulated_collector(self, broker, inbox):
+        # Readings that turn up after the controller has acted on their cycle are stale and dropped
+        while True:
+            arrival, (cycle, i, lux) = await inbox.get()
+            if cycle != self.cycle:
+                continue
+            self.reading_latency.append(arrival - self.cycle_start)
+            if self.cycle_ready.is_set():
+                continue
+            self.measured_light[i] = lux
+            self.cycle_readings += 1
+            if self.cycle_readings == self.quorum_readings:
+                self.cycle_ready.set()
+
+    async def emulated_dimmer(self, clock, broker):
+        changes = []
+        for p in range(self.num_profiles):
+            profile = self.get_profile_run(p)
+            steps = flatnonzero(diff(profile)) + 1
+            for j in flatnonzero(self.light_profile_idx == p):
+                changes += [(int(s), j, profile[s]) for s in steps]
+        changes.sort()
+        for s, j, level in changes:
+            await clock.sleep_until(s)
+            broker.publish(('light', j), level, s)
+
+    async def emulated_controller(self, clock, broker):
+        num_devices = self.num_emulated + 1
+        for cycle, cycle_start in enumerate(range(0, self.duration_s, self.measure_freq)):
+            await clock.sleep_until(cycle_start)
+            self.ref = self.ref_levels[cycle_start // self.ref_freq]
+            self.cycle = cycle
+            self.cycle_start = cycle_start
+            self.cycle_readings = 0
+            self.cycle_ready.clear()
+            for i in range(num_devices):
+                broker.publish(('sensor', i), (cycle, cycle_start), cycle_start)
+
+            # Act as soon as the quorum of readings is in, or at the timeout with whatever has arrived
+            await clock.wait_until(self.cycle_ready, cycle_start + self.timeout_s)
+            self.cycle_ready.set()
+            self.missed_readings += num_devices - self.cycle_readings
+
+            self.control()
+            broker.publish('blind', (cycle_start, self.h, self.theta), clock.now())
+            self.num_cycles += 1
 
     def control(self):
         if self.num_sensors == 0:
@@ -623,7 +1536,7 @@ class Root(Tk):
         room = max(mean(self.measured_light[1:]) / self.max_lux, 0)
         self.err = self.ref - room
 
-        if self.use_window.get():
+        if self.window_sensor:
             window = self.measured_light[0] / self.max_lux
             dh = -self.alpha_h * self.err * window * cos(self.theta)
             dtheta = self.alpha_theta * self.err * window * self.h * sin(self.theta)
@@ -635,13 +1548,12 @@ class Root(Tk):
         self.theta = clip(self.theta + dtheta, pi / 180, pi / 2)
 
     def initialize_sensors_and_lights(self):
-        max_lux = float(self.max_brightness.get())
         self.sensor_x = []
         self.sensor_y = []
         self.sensor_battery = []
         self.light_source_x = []
         self.light_source_y = []
-        self.light_source_level = []
+        self.light_schedules = []
         s_idx = 0
         l_idx = 0
         for patch in self.ax.patches:
@@ -656,12 +1568,34 @@ class Root(Tk):
                 x, y = patch.get_xy()
                 self.light_source_x.append(x + SW / 2)
                 self.light_source_y.append(y + SH / 2)
-                light_str = self.light_source_tabs[l_idx][3].get().split(",")
-                light = [max_lux * float(i) / 100 for i in light_str]
-                self.light_source_level.append(light)
+                self.light_schedules.append(self.light_source_tabs[l_idx][3].get())
                 l_idx += 1
+        self.compile_light_profiles()
 
-    def get_room_light(self, fraction, sunlight):
+    def compile_light_profiles(self):
+        # Fixtures with the same schedule share one profile. Timed profiles repeat daily so only one day is
+        # compiled, plain lists are spread over the run by index, so memory does not grow with the run length
+        max_lux = float(self.max_brightness.get())
+        profiles = {}
+        for light_str in self.light_schedules:
+            if light_str not in profiles:
+                profiles[light_str] = len(profiles)
+        schedules = [Dimming_Schedule(light_str) for light_str in profiles]
+        self.light_profile_idx = array([profiles[i] for i in self.light_schedules], dtype=int)
+        self.num_profiles = len(schedules)
+
+        self.daily_profiles = array([p for p, d in enumerate(schedules) if not d.stepped], dtype=int)
+        self.daily_levels = zeros((86400, len(self.daily_profiles)))
+        for col, p in enumerate(self.daily_profiles):
+            self.daily_levels[:, col] = max_lux * schedules[p].compile_day() / 100
+
+        self.even_profiles = array([p for p, d in enumerate(schedules) if d.stepped], dtype=int)
+        self.even_counts = array([len(schedules[p].levels) for p in self.even_profiles], dtype=int)
+        self.even_levels = zeros((len(self.even_profiles), self.even_counts.max(initial=1)))
+        for row, p in enumerate(self.even_profiles):
+            self.even_levels[row, :self.even_counts[row]] = max_lux * array(schedules[p].levels, dtype=float) / 100
+
+    def get_room_light(self, levels, sunlight):
         if self.num_sensors == 0:
             return 0
         window_light = WINDOW_AREA * (1 - self.h * cos(self.theta)) * sunlight
@@ -673,9 +1607,7 @@ class Root(Tk):
                 dst_x = (self.sensor_x[i] - self.light_source_x[j]) ** 2
                 dst_y = (self.sensor_y[i] - self.light_source_y[j]) ** 2
                 dst = dst_x + dst_y
-                idx = floor(fraction * len(self.light_source_level[j])).astype(int)
-                lum = self.light_source_level[j][idx]
-                lux += lum / dst
+                lux += levels[j] / dst
             luxs.append(lux)
         return mean(luxs)
 
@@ -756,6 +1688,105 @@ class Root(Tk):
         plt.legend(bbox_to_anchor=(0.5, 1.1), loc='upper center', ncol=4, prop=fontP)
         self.canvas2.draw()
 
+    def open_latency_window(self, broker):
+        self.latency_window = Toplevel(self)
+        self.latency_window.title('Control Loop Latency')
+        plot = Figure(figsize=(6, 4), dpi=100)
+        ax = plot.add_subplot()
+        canvas = FigureCanvasTkAgg(figure=plot, master=self.latency_window)
+        canvas.get_tk_widget().grid(column=0,
+                                    row=0,
+                                    padx=20,
+                                    pady=20)
+
+        # Readings show the network on its own, commands also include the wait for the reading quorum
+        stats = []
+        series = [('Sensor Reading', 1000 * array(self.reading_latency), 'g'),
+                  ('Blind Command', 1000 * array(self.loop_latency), 'b')]
+        for name, latency, color in series:
+            if len(latency) > 0:
+                ax.hist(latency, bins=50, color=color, alpha=0.6, density=True, label=name)
+                p50, p95, p99 = percentile(latency, [50, 95, 99])
+                stats.append("{}: p50 = {} ms, p95 = {} ms, p99 = {} ms, max = {} ms".format(
+                    name, round(p50, 1), round(p95, 1), round(p99, 1), round(latency.max(), 1)))
+            else:
+                stats.append("{}: none arrived".format(name))
+        ax.set_xlabel('Latency from Cycle Start [ms]')
+        ax.set_ylabel('Density')
+        ax.legend()
+        plot.tight_layout()
+        canvas.draw()
+
+        lost = self.num_cycles - len(self.loop_latency)
+        summary = "{}\n{} of {} commands lost, {} sensor readings missed the control step, {} of {} messages dropped".format(
+            "\n".join(stats), lost, self.num_cycles, self.missed_readings, broker.dropped, broker.sent)
+        self.latency_label = Label(self.latency_window,
+                                   text=summary)
+        self.latency_label.grid(column=0,
+                                row=1)
+
+    def open_kpi_window(self):
+        self.kpi_window = Toplevel(self)
+        self.kpi_window.title('Summary Metrics')
+        rows = self.kpis.summary()
+        rows.append(['Sensor Reads', sum(self.sensor_reads)])
+        if self.use_battery:
+            rows.append(['Battery Sensor Wakes', sum(self.num_wakes[array(self.sensor_battery, dtype=bool)])])
+        for row, (name, value) in enumerate(rows):
+            Label(self.kpi_window, text=name).grid(row=row,
+                                                   column=0,
+                                                   sticky='w',
+                                                   padx=5)
+            Label(self.kpi_window, text="{}".format(round(value, 3))).grid(row=row,
+                                                                          column=1,
+                                                                          padx=5)
+        if self.kpis.resumed_at is not None:
+            t = self.kpis.resumed_at
+            Label(self.kpi_window,
+                  text="Metrics start at the resume time {:02d}:{:02d}:{:02d}".format(
+                      t // 3600 % 24, t % 3600 // 60, t % 60)).grid(row=len(rows),
+                                                                     column=0,
+                                                                     columnspan=2,
+                                                                     sticky='w',
+                                                                     padx=5)
+
+        if self.kpis.err_hist is not None:
+            plot = Figure(figsize=(5, 3), dpi=100)
+            ax = plot.add_subplot()
+            hist = self.kpis.err_hist
+            ax.bar(hist.edges[:-1], hist.counts / 3600, width=hist.edges[1] - hist.edges[0], align='edge', color='b')
+            ax.set_xlabel('Tracking Error [%]')
+            ax.set_ylabel('Time [hr]')
+            plot.tight_layout()
+            canvas = FigureCanvasTkAgg(figure=plot, master=self.kpi_window)
+            canvas.get_tk_widget().grid(column=2,
+                                        row=0,
+                                        rowspan=len(rows),
+                                        padx=20,
+                                        pady=20)
+            canvas.draw()
+
+    def open_device_window(self):
+        self.device_window = Toplevel(self)
+        self.device_window.title('Battery Devices')
+        headers = ['Sensor', 'Wakes', 'Responses', 'Failed Polls', 'Radio On [s]', 'Energy [J]', 'Avg Power [mW]']
+        for col, text in enumerate(headers):
+            Label(self.device_window, text=text).grid(row=0,
+                                                      column=col,
+                                                      padx=5)
+        row = 1
+        for i in range(self.num_sensors):
+            if not self.sensor_battery[i]:
+                continue
+            avg_power = 1000 * self.energy[i] / self.duration_s
+            values = [i, self.num_wakes[i], self.num_responses[i], self.failed_polls[i],
+                      round(self.radio_on[i], 3), round(self.energy[i], 3), round(avg_power, 4)]
+            for col, value in enumerate(values):
+                Label(self.device_window, text="{}".format(value)).grid(row=row,
+                                                                        column=col,
+                                                                        padx=5)
+            row += 1
+
     def update_ui(self):
         if self.num_sensors > 0:
             self.update_sensor_notebook()